@@ -17,6 +17,8 @@ from lioptec_server.lioptec import (
 import re
 import socket
 
+_RESONATOR_RE = re.compile(rb'Resonator: (\d+)')
+
 class LioptecService(LioptecServiceBase):
     def __init__(self):
         super().__init__()
@@ -33,12 +35,14 @@ class LioptecService(LioptecServiceBase):
     async def Connect(self, request: LaserRequest):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # The laser protocol is short command/reply exchanges, so don't let Nagle hold back commands
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.socket.connect((request.ip, request.port))
         except socket.error as e:
             return IsOk(ok=False, status=f"Connection failed: {e}")
         self.socket.sendall(b"RemoteConnect\r\n")
         data = self.socket.recv(1024)
-        print(data.decode())
+        logger.debug("laser rx: %r", data)
         self.connection_ok = (b'OK' in data)
         return IsOk(ok=self.connection_ok, status=data)
     
@@ -49,7 +53,7 @@ class LioptecService(LioptecServiceBase):
         
         self.socket.sendall(b"RemoteDisconnect\r\n") # type: ignore
         data = self.socket.recv(1024) # type: ignore
-        print(data.decode())
+        logger.debug("laser rx: %r", data)
         return IsOk(ok=(b'OK' in data), status=data)
         
 
@@ -59,7 +63,7 @@ class LioptecService(LioptecServiceBase):
         
         self.socket.sendall(f"SetWavelength {request.wavelength}\r\n".encode("utf-8")) # type: ignore
         data = self.socket.recv(1024) # type: ignore
-        print(data.decode())
+        logger.debug("laser rx: %r", data)
         wavelength_ok = (b'OK' in data)
         if wavelength_ok:
             self.wavelength = request.wavelength
@@ -76,7 +80,7 @@ class LioptecService(LioptecServiceBase):
         # Ask for the current resonator position
         self.socket.sendall(b"GetActualPosition\r\n") # type: ignore
         data = self.socket.recv(1024) # type: ignore
-        match = re.search(r'Resonator: (\d+)', data.decode())
+        match = _RESONATOR_RE.search(data)
         if match:
             resonator = int(match.group(1))
             if resonator == self.last_resonator_position:
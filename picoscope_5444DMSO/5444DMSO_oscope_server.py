@@ -33,10 +33,24 @@ import tempfile
 
 from time import sleep
 import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from enum import Enum
 import json
 
+# Full-scale input ranges in mV, indexed by PS5000A_RANGE (same table as picosdk's adc2mV)
+_CHANNEL_INPUT_RANGES_MV = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000)
+
+# The +/- voltage scales the scope supports (10 mV ... 50 V), in PS5000A_RANGE order
+_VALID_VOLTAGE_SCALES = tuple(
+    first_digit * (10**(exponent - 3)) for exponent in (1, 2, 3, 4) for first_digit in (1, 2, 5)
+)
+_VALID_VOLTAGE_SCALE_NAMES = tuple(
+    f'+/-{si_format(channel_range)}V : {range_key}'
+    for channel_range, range_key in zip(_VALID_VOLTAGE_SCALES, ps.PS5000A_RANGE.keys())
+)
+
 class osci_channel():
     def __init__(self, channel_idx):
         self.channel_initialized = False
@@ -74,8 +88,8 @@ class PS5444DMSO_oscope_server(LabradServer):
     name = 'PS5444DMSO'
 
     def initServer(self):
-        self.valid_voltage_scale_names, self.valid_voltage_scales \
-            = self.util_generate_valid_voltage_scales()
+        self.valid_voltage_scale_names = _VALID_VOLTAGE_SCALE_NAMES
+        self.valid_voltage_scales = _VALID_VOLTAGE_SCALES
 
         # Open 5000 series PicoScope
         # Resolution set to 12 Bit
@@ -92,8 +106,18 @@ class PS5444DMSO_oscope_server(LabradServer):
         self.next_tag = 'notag';
 
         self.save_data = False
+        # Compressing and uploading to the data saver happens off the capture thread.
+        # At most two waveforms wait for it; beyond that new waveforms are not saved.
+        self._save_exec = ThreadPoolExecutor(max_workers = 1)
+        self._save_slots = threading.BoundedSemaphore(2)
         self.last_waveform_shared = False
         self.Vch = []
+        # Held while the callback rewrites the reused frame, so readers never see two captures mixed
+        self._frame_lock = threading.Lock()
+        self._has_waveform = False
+        self._frame = None
+        self._raw_i16 = {}
+        self.n_samples = None
 
         self.repeat = False
 
@@ -108,6 +132,9 @@ class PS5444DMSO_oscope_server(LabradServer):
         self.tagging_enum = Enum('tag state', [('NO_TAG', 0), ('TAG_READY', 1), ('WAVEFORM_TAGGED', 2), ('WAVEFORM_NOT_SENT', 3), ('TAG_EXPIRED', 4)])
         self.tag_state = self.tagging_enum.NO_TAG
         self.tag = ''
+        # Bound once for new_waveform_available / send_tag, which clients poll in tight loops
+        self._TS_WF_NOT_SENT = self.tagging_enum.WAVEFORM_NOT_SENT
+        self._TS_WF_TAGGED_VALUE = self.tagging_enum.WAVEFORM_TAGGED.value
 
         # Initialize oscilloscope channel settings recording
         self.channels = [osci_channel(idx) for idx in range(4)]
@@ -120,6 +147,8 @@ class PS5444DMSO_oscope_server(LabradServer):
         self.status = {}
         # Returns handle to chandle for use in future API functions
         self.status["openunit"] = ps.ps5000aOpenUnit(ctypes.byref(self.chandle), None, self.resolution)
+        # A fresh handle has no data buffers registered
+        self._buffers_bound = False
         # Open Picoscope and configure the power source
         try:
             assert_pico_ok(self.status["openunit"])
@@ -143,21 +172,10 @@ class PS5444DMSO_oscope_server(LabradServer):
             print("Waiting loop thread join.")
             self.loop_thread.join()
             print("Loop thread gracefully killed.")
+        self._save_exec.shutdown(wait = True)
         ps.ps5000aCloseUnit(self.chandle)
         print("Picoscope disconnected.")
 
-    def util_generate_valid_voltage_scales(self):
-        idx = -1
-        valid_scale_names = []
-        valid_scales = []
-        for exponent in [1, 2, 3, 4]:
-            for first_digit in [1, 2, 5]:
-                idx += 1
-                channel_range = first_digit * (10**(exponent - 3))
-                valid_scales.append(channel_range)
-                valid_scale_names.append(f'+/-{si_format(channel_range)}V : {list(ps.PS5000A_RANGE.keys())[idx]}')
-        return valid_scale_names, valid_scales
-
     def util_timebase_sampling_rate_8bit(self, n):
         if n < 0 or n > (2**32 - 1):
             raise Exception("Invalid timebase input")
@@ -213,6 +231,8 @@ class PS5444DMSO_oscope_server(LabradServer):
             self.maxADC = ctypes.c_int16()
             self.status["maximumValue"] = ps.ps5000aMaximumValue(self.chandle, ctypes.byref(self.maxADC))
             assert_pico_ok(self.status["maximumValue"])
+            # The ADC scale factors depend on maxADC
+            self.util_allocate_frame()
 
     @setting(8, channel_idx = 'i', range_idx = 'i', coupling_type = 's')
     def set_active_channel(self, c, channel_idx, range_idx, coupling_type):
@@ -235,6 +255,7 @@ class PS5444DMSO_oscope_server(LabradServer):
         )
         assert_pico_ok(self.status["setActiveChannel"])
         self.channels[channel_idx].activate_channel(range_idx, coupling_type)
+        self.util_allocate_frame()
         self.done_updating_settings()
 
     @setting(28, channel_idx = 'i')
@@ -252,6 +273,7 @@ class PS5444DMSO_oscope_server(LabradServer):
         )
         assert_pico_ok(self.status["DeactivateChannel"])
         self.channels[channel_idx].deactivate_channel()
+        self.util_allocate_frame()
         self.done_updating_settings()
 
     @setting(9, timebase = 'i', n_samples = 'i')
@@ -266,8 +288,32 @@ class PS5444DMSO_oscope_server(LabradServer):
         print("NEW TIMEBASE: sample interval: %.3g ns, max returned samples %d" % (timeIntervalns.value, returnedMaxSamples.value))
         self.time_interval_ns = float(timeIntervalns.value)
         assert_pico_ok(self.status["getTimebase2"])
+        self.util_allocate_frame()
         self.done_updating_settings()
 
+    def util_allocate_frame(self):
+        # One contiguous (time + active channels) x samples frame, reused for every waveform.
+        # Row 0 is the time axis, which only changes with the timebase, so it is filled here once.
+        if self.n_samples is None:
+            return
+        active_channels = [channel for channel in self.channels if channel.is_active()]
+        # float32 is ample for at most 16-bit ADC data and halves the bytes compressed and sent
+        self._frame = np.empty((len(active_channels) + 1, self.n_samples), dtype = np.float32)
+        # Integer sample index times the interval, computed in float64 and rounded once into the float32 frame.
+        # float32 keeps ~7 significant digits, so for long records the spacing near the end is coarse
+        # (1M samples at 2 ns: ~0.24 ns resolution); recompute from the index if that matters.
+        self._frame[0] = np.arange(self.n_samples, dtype = np.int64) * (float(self.time_interval_ns) * 1.0e-9)
+        # Raw ADC buffers handed to the driver, one row per active channel of a single numpy array,
+        # so every channel is converted by one ufunc call
+        self._raw2d = np.empty((len(active_channels), self.n_samples), dtype = np.int16)
+        self._raw_i16 = {channel.channel_idx: self._raw2d[row] for row, channel in enumerate(active_channels)}
+        # ADC counts -> volts, per row of self._raw2d
+        self._scales = np.array([
+            _CHANNEL_INPUT_RANGES_MV[channel.read_range_idx()] * 1.0e-3 / self.maxADC.value
+            for channel in active_channels
+        ], dtype = np.float32)
+        self._buffers_bound = False
+
     @setting(10, trigger_channel = 'i', threshold_V = 'v[]', direction = 's', holdoff = 'i')
     def set_trigger(self, c, trigger_channel, threshold_V, direction, holdoff):
         self.wait_to_update_settings()
@@ -365,23 +411,23 @@ class PS5444DMSO_oscope_server(LabradServer):
             print("Picoscope block capture cancelled")
         else:
             # Read off the data, send it to the data saver server
-            trace_dict1 = {}
-            trace_dict2 = {}
-            for channel in self.channels:
-                if channel.is_active():
-                    # First, prepare the buffer for the data
-                    trace_dict1[channel] = (ctypes.c_int16 * self.n_samples)()
-                    trace_dict2[channel] = (ctypes.c_int16 * self.n_samples)()
-                    self.status["setDataBuffers"] = ps.ps5000aSetDataBuffers(
-                        self.chandle, 
-                        channel.channel_idx, 
-                        ctypes.byref(trace_dict1[channel]), 
-                        ctypes.byref(trace_dict2[channel]), 
-                        self.n_samples, 
-                        0, 
-                        0
-                    )
-                    assert_pico_ok(self.status["setDataBuffers"])
+            if not self._buffers_bound:
+                # Registration persists across captures, so this only runs after the buffers or handle change
+                for channel in self.channels:
+                    if channel.is_active():
+                        # First, point the driver at the buffer for the data.
+                        # No min buffer: it is only written when aggregating, and we read with ratio mode none
+                        self.status["setDataBuffers"] = ps.ps5000aSetDataBuffers(
+                            self.chandle, 
+                            channel.channel_idx, 
+                            self._raw_i16[channel.channel_idx].ctypes.data_as(ctypes.POINTER(ctypes.c_int16)), 
+                            None, 
+                            self.n_samples, 
+                            0, 
+                            0
+                        )
+                        assert_pico_ok(self.status["setDataBuffers"])
+                self._buffers_bound = True
             # Read off the data
             # create overflow loaction
             overflow = ctypes.c_int16()
@@ -399,19 +445,28 @@ class PS5444DMSO_oscope_server(LabradServer):
                 self.open_picoscope()
             else:
                 assert_pico_ok(self.status["getValues"])
-                time = np.linspace(0.0, float((self.n_samples - 1) * self.time_interval_ns) * 1.0e-9, self.n_samples)
-                self.Vch = [time]
-                for channel in self.channels:
-                    if channel.is_active():
-                        # Convert it to human readable units
-                        self.Vch.append(np.array(adc2mV(trace_dict1[channel], channel.read_range_idx(), self.maxADC), dtype = 'float') * 1.0e-3)
+                # Convert it to human readable units, all channels at once, straight into the frame
+                with self._frame_lock:
+                    np.multiply(self._raw2d, self._scales[:, None], out = self._frame[1:])
+                    self.Vch = self._frame
+                # Like the old len(self.Vch) > 1: a frame holding only the time axis is not a waveform
+                self._has_waveform = self._frame.shape[0] > 1
 
                 if self.save_data:
-                    # Send it to the data saver!
-                    self.client.data_saver.add_data_item(f"picoscope_trace__ch{channel}_tag_{self.next_tag}_{waveform_timestamp}", 
-                                                          "no description for now.  add later.", 
-                                                          self.encode_data_numpy_to_bytes(np.vstack(self.Vch)))
-                    print("Data sent to data_saver")
+                    # Send it to the data saver!  The frame is reused by the next block, so hand over a copy
+                    if self._save_slots.acquire(blocking = False):
+                        channels = '_'.join(str(idx) for idx in self._raw_i16)
+                        try:
+                            self._save_exec.submit(self.util_save_waveform, 
+                                                   f"picoscope_trace__ch{channels}_tag_{self.next_tag}_{waveform_timestamp}", 
+                                                   self._frame.copy())
+                        except Exception:
+                            # e.g. the executor was already shut down; util_save_waveform won't release the slot
+                            self._save_slots.release()
+                            print("Could not queue waveform for the data saver:")
+                            traceback.print_exc()
+                    else:
+                        print("Data saver backlogged, waveform not saved")
 
                 self.last_waveform_shared = False
                 self.running = False
@@ -426,6 +481,19 @@ class PS5444DMSO_oscope_server(LabradServer):
             # print("Callback repeat")
             self.callback_repeat.set()
 
+    def util_save_waveform(self, name, frame):
+        # Runs on self._save_exec.  Nobody waits on the returned future, so errors are reported here.
+        try:
+            self.client.data_saver.add_data_item(name, 
+                                                  "no description for now.  add later.", 
+                                                  self.encode_data_numpy_to_bytes(frame))
+            print("Data sent to data_saver")
+        except Exception:
+            print(f"Failed to save waveform {name}:")
+            traceback.print_exc()
+        finally:
+            self._save_slots.release()
+
     @setting(21, rid = 'i', sweep_param = 'v[]')
     def tag_next(self, c, rid, sweep_param):
         if self.repeat:
@@ -439,7 +507,7 @@ class PS5444DMSO_oscope_server(LabradServer):
 
     @setting(22, returns = 'b')
     def new_waveform_available(self, c):
-        available = (not self.last_waveform_shared) and (len(self.Vch) > 1)
+        available = self._has_waveform and not self.last_waveform_shared
         self.last_waveform_shared = True
         return available
 
@@ -448,14 +516,17 @@ class PS5444DMSO_oscope_server(LabradServer):
         self.last_waveform_shared = True
         if self.running:
             self.tag_state = self.tagging_enum.TAG_EXPIRED
-            return self.encode_data_numpy_to_bytes(np.vstack(self.Vch))
+            # Snapshot the frame, then compress outside the lock so the next capture isn't held up
+            with self._frame_lock:
+                frame = self.Vch.copy()
+            return self.encode_data_numpy_to_bytes(frame)
         else:
             return b'NONE'
 
     @setting(24, returns = '(is)')
     def send_tag(self, c):
-        if self.tag_state == self.tagging_enum.WAVEFORM_NOT_SENT:
-            return self.tagging_enum.WAVEFORM_TAGGED.value, self.tag
+        if self.tag_state is self._TS_WF_NOT_SENT:
+            return self._TS_WF_TAGGED_VALUE, self.tag
         return self.tag_state.value, self.tag
 
 # create an instance of our server class
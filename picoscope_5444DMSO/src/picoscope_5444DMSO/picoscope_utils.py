@@ -1,5 +1,5 @@
 # Picoscope imports
-from collections.abc import AsyncIterator
+from collections.abc import AsyncIterator, Callable
 from picosdk.ps5000a import ps5000a as ps
 from picosdk.functions import adc2mV, assert_pico_ok, mV2adc
 from picosdk.constants import PICO_STATUS
@@ -7,8 +7,12 @@ from picosdk.constants import PICO_STATUS
 # Utility imports
 import ctypes
 import asyncio
+import collections
+import itertools
 import logging
-import datetime
+import queue
+import threading
+import time
 from si_prefix import si_format
 import numpy as np
 
@@ -44,17 +48,58 @@ channel_dict = {
 
 NUM_CHANNELS = 4
 
+# Constant ctypes arguments, built once instead of on every driver call
+_C_INT16_ZERO = ctypes.c_int16(0)
+_C_INT16_ONE = ctypes.c_int16(1)
+_C_UINT32_ZERO = ctypes.c_uint32(0)
+
+# Driver functions and constants used on every block, bound once so the hot path skips the lookups
+_RunBlock = ps.ps5000aRunBlock
+_GetValues = ps.ps5000aGetValues
+_GetValuesBulk = ps.ps5000aGetValuesBulk
+_RATIO_MODE_NONE = ps.PS5000A_RATIO_MODE['PS5000A_RATIO_MODE_NONE']
+_PICO_OK = PICO_STATUS['PICO_OK']
+_PICO_NOT_RESPONDING = PICO_STATUS['PICO_NOT_RESPONDING']
+
+# Raw-data slots between the driver callback and the conversion worker
+_RING_SLOTS = 4
+
+# Most blocks merged into one streamed AllTraces message when the client falls behind
+_MAX_BLOCKS_PER_MESSAGE = 16
+
+# Messages waiting for the client; room for one full batch, beyond that the oldest is dropped
+_QUEUE_MAXSIZE = _MAX_BLOCKS_PER_MESSAGE
+
+# TODO: use PS5000AGetChannelInformation to get the valid ranges
+# The +/- voltage scales the scope supports (10 mV ... 50 V), in PS5000A_RANGE order
+_VALID_SCALES = tuple(
+    first_digit * (10**(exponent - 3)) for exponent in (1, 2, 3, 4) for first_digit in (1, 2, 5)
+)
+_VALID_SCALE_NAMES = tuple(
+    f'+/-{si_format(channel_range)}V : {range_key}'
+    for channel_range, range_key in zip(_VALID_SCALES, ps.PS5000A_RANGE.keys())
+)
+# Index into _VALID_SCALES by the scale in whole mV, so a float32 scale from the wire still matches
+_SCALE_IDX_BY_MV = {round(scale * 1e3): scale_idx for scale_idx, scale in enumerate(_VALID_SCALES)}
+# PS5000A_RANGE value for each entry of _VALID_SCALES, looked up by index rather than by float key
+_RANGE_BY_IDX = tuple(
+    ps.PS5000A_RANGE[range_key] for _, range_key in zip(_VALID_SCALES, ps.PS5000A_RANGE.keys())
+)
+
 class _osci_channel():
     def __init__(self, channel_idx):
         self.channel_initialized = False
         self.channel_idx = channel_idx
         self.range_idx = None
         self.coupling_type = None
+        self.volts_per_count = None
         self.active = False
 
-    def activate_channel(self, range_idx, coupling_type):
+    def activate_channel(self, range_idx, coupling_type, max_adc):
         self.range_idx = range_idx
         self.coupling_type = coupling_type
+        # ADC counts -> volts for this range, so the block callback doesn't need adc2mV
+        self.volts_per_count = _VALID_SCALES[range_idx] / max_adc
         self.channel_initialized = True
         self.active = True
 
@@ -82,27 +127,60 @@ class Timebase():
         self.sample_interval_ns = None
         self.preTriggerSamples = None
         self.postTriggerSamples = None
+        self.n_captures = 1
 
 class PicoscopeUtils(PicoscopeUtilsBase):
     def __init__(self) -> None:
         self.picoscope_open = False
         self.logger = logging.getLogger(__name__)
         self.logger.info("Config initialized")
-        self.valid_scale_names, self.valid_scales = self.util_generate_valid_voltage_scales()
+        self.valid_scale_names = _VALID_SCALE_NAMES
+        self.valid_scales = _VALID_SCALES
+        self.logger.info(f"voltage scales: {self.valid_scale_names}")
         self.open_picoscope()
 
         self.timebase = Timebase()
+        # Set by configure_timebase; util_run_block passes the ctypes arguments as they are
+        self.n_samples: int | None = None
+        self.n_captures = 1
+        self._c_pre_trigger: ctypes.c_int32 | None = None
+        self._c_post_trigger: ctypes.c_int32 | None = None
+        self._c_timebase_idx: ctypes.c_uint32 | None = None
 
         self._channel_info = []
         for idx in range(NUM_CHANNELS):
             channel = _osci_channel(idx)
             self._channel_info.append(channel)
+        # Kept in sync by configure_channel, so nothing downstream has to filter with is_active()
+        self._active_channels: list[_osci_channel] = []
 
         self.logger.info("Trace Streamer initialized")
         # These will be set once stream_traces() starts running:
         self.queue: asyncio.Queue[AllTraces] | None = None
         self.loop: asyncio.AbstractEventLoop | None = None
         self.cFuncPtr = None
+        # GetValues/GetValuesBulk call with its arguments bound for the current buffer layout; see _make_read_block()
+        self._read_block: Callable[[], int] | None = None
+        # Capture buffers registered with the driver, one row per active channel; see _ensure_buffers()
+        self._raw: np.ndarray = np.empty((0, 0), dtype=np.int16)
+        self._raw_rows: dict[int, np.ndarray] = {}
+        self._buffers_n_samples: int | None = None
+        self._buffers_n_captures = 1
+        # Guards the buffer layout: _ensure_buffers runs on the driver thread while streaming, and must not
+        # record a layout that configure_channel/configure_timebase invalidated while it was registering.
+        self._layout_lock = threading.Lock()
+        # Ring of raw int16 slots (one row per active channel) handed from block_ready_callback to
+        # _conversion_worker.  Free slots wait in _free_slots, filled ones in _ready_slots, which
+        # (like the worker) belongs to a single stream_traces call, so a late block can't leak into the next stream.
+        self._free_slots: queue.SimpleQueue[np.ndarray] = queue.SimpleQueue()
+        self._ready_slots: queue.SimpleQueue | None = None
+        self._slot_channels: list[tuple[int, float]] = []
+        self._worker: threading.Thread | None = None
+        # While set, block_ready_callback re-arms the scope as soon as a block has been read out
+        self._streaming = False
+        # Messages finished by the worker, waiting to be moved onto self.queue by the event loop
+        self._ready_msgs: collections.deque[AllTraces] = collections.deque()
+        self._drain_pending = False
 
 
     def open_picoscope(self):
@@ -179,21 +257,26 @@ class PicoscopeUtils(PicoscopeUtilsBase):
         if message.channel_coupling not in coupling_type_dict:
             self.logger.error(f"Invalid coupling type: {message.channel_coupling}. Must be 0 or 1.")
             raise ValueError(f"Invalid coupling type: {message.channel_coupling}. Must be 0 or 1.")
-        # Check if the voltage scale is valid
-        if message.channel_voltage_scale not in self.valid_scales:
-            self.logger.error(f"Invalid voltage scale: {message.channel_voltage_scale}. Must be one of the valid scales.")
-            raise ValueError(f"Invalid voltage scale: {message.channel_voltage_scale}. Must be one of the valid scales.")
+        # Check if the voltage scale is valid, and find its index for the range lookups below
+        if message.channel_voltage_scale is None:
+            self.logger.error("Missing voltage scale. Must be one of the valid scales.")
+            raise ValueError("Missing voltage scale. Must be one of the valid scales.")
+        voltage_scale = message.channel_voltage_scale.valid_scale_voltage
+        scale_idx = _SCALE_IDX_BY_MV.get(round(voltage_scale * 1e3))
+        if scale_idx is None:
+            self.logger.error(f"Invalid voltage scale: {voltage_scale}. Must be one of the valid scales.")
+            raise ValueError(f"Invalid voltage scale: {voltage_scale}. Must be one of the valid scales.")
         
         self.logger.info(f"Configuring channel {message.channel_idx} with coupling {coupling_type_dict[message.channel_coupling]}")
-        self.logger.info(f"Voltage scale set to {message.channel_voltage_scale} V")
+        self.logger.info(f"Voltage scale set to {self.valid_scales[scale_idx]} V")
 
         try:
             self.status["setActiveChannel"] = ps.ps5000aSetChannel(
                 self.chandle, 
                 channel_dict[message.channel_idx], 
-                ctypes.c_int16(1) if message.activate else ctypes.c_int16(0),
+                _C_INT16_ONE if message.activate else _C_INT16_ZERO,
                 coupling_type_dict[message.channel_coupling], 
-                self.voltage_to_range[message.channel_voltage_scale],
+                _RANGE_BY_IDX[scale_idx],
                 message.analog_offset_volts if message.analog_offset_volts is not None else 0.0,
             )
         except Exception as e:
@@ -203,11 +286,16 @@ class PicoscopeUtils(PicoscopeUtilsBase):
             )
         if message.activate:
             self._channel_info[message.channel_idx].activate_channel(
-                self.valid_scales.index(message.channel_voltage_scale), 
-                message.channel_coupling
+                scale_idx, 
+                message.channel_coupling,
+                self.maxADC.value,
             )
         else:
             self._channel_info[message.channel_idx].deactivate_channel()
+        with self._layout_lock:
+            self._active_channels = [channel for channel in self._channel_info if channel.is_active()]
+            # The set of capture buffers follows the set of active channels
+            self._buffers_n_samples = None
         return ChannelResponse(
             success=True,
             message=None
@@ -224,24 +312,56 @@ class PicoscopeUtils(PicoscopeUtilsBase):
         return await super().get_shortest_timebase(message)
 
     async def configure_timebase(self, message: TimebaseRequest) -> TimebaseResponse:
-        self.logger.info(f"Configuring timebase: {message.timebase_idx} with {message.n_samples_pre_trigger} + {message.n_samples_post_trigger} samples")
-        timeIntervalns = ctypes.c_int32()
-        returnedMaxSamples = ctypes.c_int32()
-        self.status["getTimebase2"] = ps.ps5000aGetTimebase(
-            self.chandle, 
-            message.timebase_idx, 
-            message.n_samples_pre_trigger + message.n_samples_post_trigger, 
-            ctypes.byref(timeIntervalns),
-            ctypes.byref(returnedMaxSamples), 
-            0,
-        )
-        print("NEW TIMEBASE: sample interval: %.3g ns, max returned samples %d" % (timeIntervalns.value, returnedMaxSamples.value))
-        self.time_interval_ns = float(timeIntervalns.value)
-        assert_pico_ok(self.status["getTimebase2"])
-        self.timebase.timebase_idx = message.timebase_idx
-        self.timebase.sample_interval_ns = timeIntervalns.value
-        self.timebase.preTriggerSamples = message.n_samples_pre_trigger
-        self.timebase.postTriggerSamples = message.n_samples_post_trigger
+        n_captures = max(message.n_captures, 1)
+        self.logger.info(f"Configuring timebase: {message.timebase_idx} with {message.n_samples_pre_trigger} + {message.n_samples_post_trigger} samples, {n_captures} capture(s) per block")
+        n_samples = message.n_samples_pre_trigger + message.n_samples_post_trigger
+        with self._layout_lock:
+            # The registered segment buffers must be detached while their segments still exist;
+            # _ensure_buffers registers the new layout before the next block
+            self._detach_buffers()
+            # Rapid block mode: the memory is split into one segment per capture, and a single RunBlock
+            # fills all of them before the callback fires.  Has to happen before GetTimebase, whose
+            # returned max samples accounts for both the segments and the enabled channels.
+            self._set_segments(n_captures)
+            timeIntervalns = ctypes.c_int32()
+            returnedMaxSamples = ctypes.c_int32()
+            self.status["getTimebase2"] = ps.ps5000aGetTimebase(
+                self.chandle, 
+                message.timebase_idx, 
+                n_samples, 
+                ctypes.byref(timeIntervalns),
+                ctypes.byref(returnedMaxSamples), 
+                0,
+            )
+            print("NEW TIMEBASE: sample interval: %.3g ns, max returned samples %d" % (timeIntervalns.value, returnedMaxSamples.value))
+            # On failure, put the previous segmentation back; self.n_captures still describes it
+            try:
+                assert_pico_ok(self.status["getTimebase2"])
+            except Exception:
+                self._set_segments(self.n_captures)
+                raise
+            if n_samples > returnedMaxSamples.value:
+                self._set_segments(self.n_captures)
+                description = f"{n_samples} samples exceed the {returnedMaxSamples.value} available per capture with {n_captures} capture(s) and the enabled channels"
+                self.logger.error(description)
+                return TimebaseResponse(
+                    timebase_idx = message.timebase_idx,
+                    sample_interval_ns = 0,
+                    success = False,
+                    description = description,
+                )
+            # Recorded under the lock, so a re-arm on the driver thread never pairs the new segmentation with the old layout
+            self.time_interval_ns = float(timeIntervalns.value)
+            self.timebase.timebase_idx = message.timebase_idx
+            self.timebase.sample_interval_ns = timeIntervalns.value
+            self.timebase.preTriggerSamples = message.n_samples_pre_trigger
+            self.timebase.postTriggerSamples = message.n_samples_post_trigger
+            self.timebase.n_captures = n_captures
+            self.n_samples = n_samples
+            self.n_captures = n_captures
+            self._c_pre_trigger = ctypes.c_int32(message.n_samples_pre_trigger)
+            self._c_post_trigger = ctypes.c_int32(message.n_samples_post_trigger)
+            self._c_timebase_idx = ctypes.c_uint32(message.timebase_idx)
         return TimebaseResponse(
             timebase_idx = message.timebase_idx,
             sample_interval_ns = timeIntervalns.value,
@@ -249,27 +369,16 @@ class PicoscopeUtils(PicoscopeUtilsBase):
             description = None,
         )
 
-    def util_generate_valid_voltage_scales(self):
-        # TODO: use PS5000AGetChannelInformation to get the valid ranges
-        # also, generally just fix this, it's a really bad way to do it.
-        idx = -1
-        valid_scale_names = []
-        valid_scales = []
-        # Create a mapping from voltage values to PS5000A_RANGE values
-        self.voltage_to_range = {}
-        
-        for exponent in [1, 2, 3, 4]:
-            for first_digit in [1, 2, 5]:
-                idx += 1
-                channel_range = first_digit * (10**(exponent - 3))
-                valid_scales.append(channel_range)
-                range_key = list(ps.PS5000A_RANGE.keys())[idx]
-                range_value = ps.PS5000A_RANGE[range_key]
-                self.voltage_to_range[channel_range] = range_value
-                valid_scale_names.append(f'+/-{si_format(channel_range)}V : {range_key}')
-        
-        self.logger.info(f"voltage scales: {valid_scale_names}")
-        return valid_scale_names, valid_scales
+    def _set_segments(self, n_captures: int) -> None:
+        """
+        Split the scope memory into n_captures segments and capture into all of them.  The segment size
+        MemorySegments reports is shared by all channels, so sizes are checked against GetTimebase instead.
+        """
+        maxSegmentSamples = ctypes.c_int32()
+        self.status["memorySegments"] = ps.ps5000aMemorySegments(self.chandle, n_captures, ctypes.byref(maxSegmentSamples))
+        assert_pico_ok(self.status["memorySegments"])
+        self.status["setNoOfCaptures"] = ps.ps5000aSetNoOfCaptures(self.chandle, n_captures)
+        assert_pico_ok(self.status["setNoOfCaptures"])
 
     async def get_valid_voltage_scales(self, message: Empty) -> VoltScaleList:
         response = VoltScaleList()
@@ -289,28 +398,27 @@ class PicoscopeUtils(PicoscopeUtilsBase):
 
 
     def timestamp_now(self) -> Timestamp:
-        t = datetime.datetime.now().timestamp()
-        seconds = int(t)
-        nanos = int((t % 1) * 1e9)
-        return Timestamp(seconds, nanos)
+        t_ns = time.time_ns()
+        return Timestamp(t_ns // 1_000_000_000, t_ns % 1_000_000_000)
 
-    def util_run_block(self, timebase_idx: int, preTriggerSamples: int, postTriggerSamples: int) -> bool:
+    def util_run_block(self) -> bool:
         """
         Kick off a single block‐mode capture. We assume:
          - self.cFuncPtr is already set to a ps.BlockReadyType(...) around self.block_ready_callback
-         - self.preTriggerSamples, self.n_samples, self.timebase are already configured.
+         - configure_timebase has set self.n_samples and the cached RunBlock arguments.
         """
-        if timebase_idx is None:
+        if self._c_timebase_idx is None:
             raise Exception('Timebase not initialized!')
-        self.n_samples = preTriggerSamples + postTriggerSamples
         try:
-            self.status["runBlock"] = ps.ps5000aRunBlock(
+            with self._layout_lock:
+                self._ensure_buffers(self.n_samples, self.n_captures)
+            self.status["runBlock"] = _RunBlock(
                 self.chandle,
-                ctypes.c_int32(preTriggerSamples),
-                ctypes.c_int32(postTriggerSamples),
-                ctypes.c_uint32(timebase_idx),
+                self._c_pre_trigger,
+                self._c_post_trigger,
+                self._c_timebase_idx,
                 None,
-                ctypes.c_uint32(0),
+                _C_UINT32_ZERO,
                 self.cFuncPtr,
                 None
             )
@@ -320,159 +428,305 @@ class PicoscopeUtils(PicoscopeUtilsBase):
             self.logger.error(f"Failed to start block capture: {str(e)}")
             return False
 
+    def _ensure_buffers(self, n_samples: int, n_captures: int) -> None:
+        """
+        Allocate a capture buffer for each active channel and register it with the driver.  GetValues
+        reads without downsampling, so no min/overflow buffer is needed.
+        The buffers are the rows of one (n_active, n_captures * n_samples) int16 array, in the same layout
+        as a ring slot.  Segment i of a channel is registered at offset i * n_samples of its row, so a
+        rapid block lands capture-major.
+        The registration persists across captures, so this only does work after n_samples, n_captures
+        or the set of active channels has changed.  Callers hold self._layout_lock.
+        """
+        if (n_samples, n_captures) == (self._buffers_n_samples, self._buffers_n_captures):
+            return
+        raw = np.zeros((len(self._active_channels), n_captures * n_samples), dtype=np.int16)
+        raw_rows = {channel.channel_idx: raw[row] for row, channel in enumerate(self._active_channels)}
+        c_n_samples = ctypes.c_int32(n_samples)
+        # configure_timebase detaches everything before changing the segment count, so every old segment still exists
+        old_segments = range(self._buffers_n_captures)
+        # Segments that are no longer in use are detached from the buffers we are about to free
+        for channel_idx in self._raw_rows.keys() | raw_rows.keys():
+            for segment_idx in range(max(len(old_segments), n_captures)):
+                if channel_idx in raw_rows and segment_idx < n_captures:
+                    buffer = raw_rows[channel_idx][segment_idx * n_samples:].ctypes.data_as(ctypes.POINTER(ctypes.c_int16))
+                elif channel_idx in self._raw_rows and segment_idx in old_segments:
+                    buffer = None
+                else:
+                    continue
+                self.status["setDataBuffer_{}".format(channel_idx)] = ps.ps5000aSetDataBuffer(
+                    self.chandle,
+                    channel_idx,
+                    buffer,
+                    c_n_samples,
+                    segment_idx,
+                    _RATIO_MODE_NONE
+                )
+                assert_pico_ok(self.status["setDataBuffer_{}".format(channel_idx)])
+        self._raw = raw
+        self._raw_rows = raw_rows
+        self._buffers_n_samples = n_samples
+        self._buffers_n_captures = n_captures
+        self._read_block = self._make_read_block(n_samples, n_captures)
+        # New ring for the new layout.  Slots still held by the worker go back to the old free queue.
+        self._slot_channels = [(channel.channel_idx, channel.volts_per_count) for channel in self._active_channels]
+        self._free_slots = queue.SimpleQueue()
+        for _ in range(_RING_SLOTS):
+            self._free_slots.put(np.empty_like(raw))
+
+    def _detach_buffers(self) -> None:
+        """
+        Unregister every capture buffer from every segment it was registered for, and mark the layout
+        stale so _ensure_buffers starts from scratch.  Has to run before the segment count changes:
+        the driver rejects segment indices that no longer exist.  Callers hold self._layout_lock.
+        """
+        for channel_idx in self._raw_rows:
+            for segment_idx in range(self._buffers_n_captures):
+                self.status["setDataBuffer_{}".format(channel_idx)] = ps.ps5000aSetDataBuffer(
+                    self.chandle,
+                    channel_idx,
+                    None,
+                    ctypes.c_int32(0),
+                    segment_idx,
+                    _RATIO_MODE_NONE
+                )
+                assert_pico_ok(self.status["setDataBuffer_{}".format(channel_idx)])
+        self._raw_rows = {}
+        self._buffers_n_samples = None
+
+    def _make_read_block(self, n_samples: int, n_captures: int) -> Callable[[], int]:
+        """
+        Bind the driver read-out for one buffer layout into a closure, so the block callback makes a
+        single call instead of branching and rebuilding the arguments on every block.  The ctypes
+        out-parameters live in the closure and are reused for every block.
+        The BlockReadyType trampoline itself is created once per stream and never re-bound: a block can
+        be in flight (or its callback running) when the layout changes.
+        """
+        # TODO: downsampling support?
+        chandle = self.chandle
+        if n_captures == 1:
+            c_n_samples = ctypes.c_int32()
+            c_n_samples_ref = ctypes.byref(c_n_samples)
+            overflow_ref = ctypes.byref(ctypes.c_int16())
+
+            def read_block() -> int:
+                # In/out parameter: the driver overwrites it with the number of samples returned
+                c_n_samples.value = n_samples
+                return _GetValues(chandle, _C_UINT32_ZERO, c_n_samples_ref, _C_UINT32_ZERO, _RATIO_MODE_NONE, _C_UINT32_ZERO, overflow_ref)
+        else:
+            # Rapid block mode: every segment comes back in one driver call
+            c_n_samples = ctypes.c_uint32()
+            c_n_samples_ref = ctypes.byref(c_n_samples)
+            c_last_segment = ctypes.c_uint32(n_captures - 1)
+            c_ratio = ctypes.c_uint32(1)
+            overflow = (ctypes.c_int16 * n_captures)()
+
+            def read_block() -> int:
+                c_n_samples.value = n_samples
+                return _GetValuesBulk(chandle, c_n_samples_ref, _C_UINT32_ZERO, c_last_segment, c_ratio, _RATIO_MODE_NONE, overflow)
+        return read_block
+
     def block_ready_callback(self, handle, statusCallback, param):
         """
         This is invoked on a PicoSDK thread when a block of data is ready.
-        We must:
-          1. Read out all active channels into numpy arrays,
-          2. Convert ADC->mV->V,
-          3. Build an AllTraces proto containing one Trace per active channel,
-          4. Put it into self.queue via loop.call_soon_threadsafe(...).
+        It only does what has to happen on this thread, so it returns to the driver quickly:
+          1. Read out all active channels (and all captures, in rapid block mode) into the registered
+             capture buffers,
+          2. Copy them into a free ring slot and pass it to _conversion_worker,
+          3. While streaming, start the next block right away.
         """
         ts_proto = self.timestamp_now() # First thing, record timestamp of receipt
-        if statusCallback != PICO_STATUS['PICO_OK']:
+        # The stream this block belongs to, even if stream_traces ends (and another starts) meanwhile
+        ready_slots = self._ready_slots
+        if statusCallback != _PICO_OK:
             self.logger.error(f"Block capture failed with status: {statusCallback}")
             # You could choose to signal an error‐message via the queue or raise
             return
 
-        # 1) For each active channel, set up two buffers (primary + overflow)
-        trace_raw_buffers = {}
-        for channel in self._channel_info:
-            if channel.is_active():
-                buf1 = (ctypes.c_int16 * self.n_samples)()
-                buf2 = (ctypes.c_int16 * self.n_samples)()
-                self.status["setDataBuffers_{}".format(channel.channel_idx)] = ps.ps5000aSetDataBuffers(
-                    self.chandle,
-                    channel.channel_idx,
-                    ctypes.byref(buf1),
-                    ctypes.byref(buf2),
-                    ctypes.c_int32(self.n_samples),
-                    0,
-                    0
-                )
-                assert_pico_ok(self.status["setDataBuffers_{}".format(channel.channel_idx)])
-                trace_raw_buffers[channel.channel_idx] = buf1
-
-        # 2) Pull all values from the scope
-        overflow = ctypes.c_int16()
-        cmaxSamples = ctypes.c_int32(self.n_samples)
-        # TODO: downsampling support?
-        self.status["getValues"] = ps.ps5000aGetValues(
-            self.chandle,
-            ctypes.c_uint32(0),
-            ctypes.byref(cmaxSamples),
-            ctypes.c_uint32(0),
-            ps.PS5000A_RATIO_MODE['PS5000A_RATIO_MODE_NONE'],
-            ctypes.c_uint32(0),
-            ctypes.byref(overflow)
-        )
-        if self.status["getValues"] == PICO_STATUS["PICO_NOT_RESPONDING"]:
+        # 1) Pull all values from the scope into the buffers registered by _ensure_buffers()
+        self.status["getValues"] = self._read_block()
+        if self.status["getValues"] == _PICO_NOT_RESPONDING:
             self.logger.error("PICOSCOPE CRASH DETECTED")
             return
         else:
             assert_pico_ok(self.status["getValues"])
 
-        # 3) Convert time base -> seconds; convert ADC -> volts
-        time_axis = np.linspace(
-            0.0,
-            float((self.n_samples - 1) * self.time_interval_ns) * 1.0e-9,
-            num=self.n_samples
-        )
-        # List of numpy arrays: index 0 is time_axis, then each channel’s voltage array in volts.
-        Vch = [time_axis]
-        for channel in self._channel_info:
-            if channel.is_active():
-                raw_buf = trace_raw_buffers[channel.channel_idx]
-                # Convert raw ADC to mV, then to V
-                volts = np.array(
-                    adc2mV(raw_buf, channel.read_range_idx(), self.maxADC),
-                    dtype='float'
-                ) * 1.0e-3
-                Vch.append(volts)
-
-        # 4) Build AllTraces proto
-        all_traces_msg = AllTraces()
+        # 2) Copy into a ring slot; the worker returns the slot to free_slots once it is converted
+        free_slots = self._free_slots
+        try:
+            slot = free_slots.get_nowait()
+        except queue.Empty:
+            self.logger.warning("Conversion worker is behind, dropping block")
+        else:
+            np.copyto(slot, self._raw)
+            ready_slots.put((slot, free_slots, self._slot_channels, self._buffers_n_captures, ts_proto))
 
-        idx = 1  # index into Vch: Vch[1] corresponds to first active channel
-        for channel in self._channel_info:
-            if channel.is_active():
-                # message ChannelTrace {
-                #     int32 channel_idx = 1;
-                #     int32 channel_data_idx = 2; // Set to zero if the only data is the trace.  For some acquisition modes, there may be more than one data stream for channel, e.g. min, max, mean from picoscope
-
-                #     int32 sample_interval_ns = 21;
-                #     int32 trigger_holdoff_ns = 22;
-
-                #     int32 trace_resolution_bits = 31;
-                #     float volt_scale_volts = 32; // This represents the +/- range of the oscilloscope, so the full range is double the value passed here
-                #     float volt_offset_volts = 33; // Offset of the center of the voltage range from 0V
-
-                #     int32 number_captures = 81; // For multiple acquisitions of waveforms, e.g. Picoscope Rapid Block Mode
-                #     int32 accumulation_method = 82; // 0 for single-shot acquisition.  1: Averaging
-
-                #     Timestamp timestamp = 91;
-                #     int32 acquisition_mode = 92;  // TODO: determine a mapping from Picoscope modes to integers
-                #     int32 osci_coupling = 93; // 0:DC coupling, 1:AC coupling
-
-                #     int32 trace_length = 100;
-                #     repeated float trace = 101;
-                #     repeated float times = 102;
-                # }
-                # TODO: populate metadata
-                trace_proto = ChannelTrace()
-                trace_proto.channel_idx = channel.channel_idx
-                trace_proto.timestamp = ts_proto
-                trace_proto.sample_interval_ns = self.timebase.sample_interval_ns
-                # sample_interval in seconds (time_interval_ns * 1e-9)
-                trace_proto.sample_interval = float(self.time_interval_ns) * 1.0e-9
-                # We store the waveform as a repeated field of doubles (one per sample)
-                trace_proto.trace = Vch[idx].tolist()
-                trace_proto.times = time_axis.tolist()
-                idx += 1
-                all_traces_msg.traces.append(trace_proto)
-
-        # 5) Hand off to asyncio side
-        if (self.loop is not None) and (self.queue is not None):
-            self.loop.call_soon_threadsafe(self.queue.put_nowait, all_traces_msg)
+        # 3) The driver only writes the capture buffers during GetValues, and this block has been copied out,
+        #    so the next acquisition can run while the worker converts this one
+        if self._streaming:
+            self.util_run_block()
+
+    def _conversion_worker(self, ready_slots: queue.SimpleQueue) -> None:
+        """
+        Runs on its own thread while stream_traces is active. For each filled ring slot in ready_slots:
+          1. Build an AllTraces proto containing one Trace of raw ADC counts per active channel and capture,
+          2. Hand it to the event loop via _publish().
+        A None item stops the worker.
+        """
+        while True:
+            item = ready_slots.get()
+            if item is None:
+                return
+            slot, free_slots, slot_channels, n_captures, ts_proto = item
+            try:
+                all_traces_msg = self._build_all_traces(slot, slot_channels, n_captures, ts_proto)
+            except Exception:
+                # One bad block must not end the stream: drop it and keep converting
+                self.logger.exception("Failed to build traces for block, dropping it")
+                continue
+            finally:
+                free_slots.put(slot)
+
+            # 2) Hand off to asyncio side
+            self._publish(all_traces_msg)
+
+    def _publish(self, all_traces_msg: AllTraces) -> None:
+        """Pass a message from the worker thread to the event loop. Only the first message of a burst
+        pays for a call_soon_threadsafe wakeup; later ones ride along on the drain already scheduled."""
+        if (self.loop is None) or (self.queue is None):
+            return
+        self._ready_msgs.append(all_traces_msg)
+        if not self._drain_pending:
+            self._drain_pending = True
+            self.loop.call_soon_threadsafe(self._drain_ready_msgs)
+
+    def _drain_ready_msgs(self) -> None:
+        # Clear the flag before draining, so a message appended meanwhile is either drained here
+        # or schedules a fresh drain
+        self._drain_pending = False
+        while self._ready_msgs:
+            if self.queue.full():
+                # The client is not keeping up: keep the most recent blocks rather than growing without bound
+                self.queue.get_nowait()
+                self.logger.warning("Client is behind, dropping oldest block")
+            self.queue.put_nowait(self._ready_msgs.popleft())
+
+    def _build_all_traces(self, slot: np.ndarray, slot_channels: list[tuple[int, float]], n_captures: int, ts_proto: Timestamp) -> AllTraces:
+        """
+        Convert one ring slot (rows ordered as slot_channels, each row holding n_captures traces back to
+        back) into an AllTraces message.  Traces are ordered capture by capture, channels within a capture.
+        """
+        all_traces_msg = AllTraces()
+        # Clipped samples sit at (or beyond) +/-maxADC.  One integer compare over the whole slot counts
+        # them for every channel and capture at once, before anything is serialized.
+        max_adc = np.int16(self.maxADC.value)
+        saturated = (slot >= max_adc) | (slot <= -max_adc)
+        # Explicit trace length: with no active channels the slot is empty and -1 can't be inferred
+        n_saturated = np.count_nonzero(saturated.reshape(len(slot_channels), n_captures, slot.shape[1] // n_captures), axis=2)
+        # Split each channel row into its captures; these are views, nothing is copied or converted here
+        per_channel_counts = [
+            (channel_idx, volts_per_count, slot[row].reshape(n_captures, -1), n_saturated[row])
+            for row, (channel_idx, volts_per_count) in enumerate(slot_channels)
+        ]
+        for capture_idx, (channel_idx, volts_per_count, channel_counts, channel_saturated) in itertools.product(range(n_captures), per_channel_counts):
+            counts = channel_counts[capture_idx]
+
+            # Add it to the AllTraces proto
+            # message ChannelTrace {
+            #     int32 channel_idx = 1;
+            #     int32 channel_data_idx = 2; // Set to zero if the only data is the trace.  For some acquisition modes, there may be more than one data stream for channel, e.g. min, max, mean from picoscope
+
+            #     int32 sample_interval_ns = 21;
+            #     int32 trigger_holdoff_ns = 22;
+
+            #     int32 trace_resolution_bits = 31;
+            #     float volt_scale_volts = 32; // This represents the +/- range of the oscilloscope, so the full range is double the value passed here
+            #     float volt_offset_volts = 33; // Offset of the center of the voltage range from 0V
+
+            #     int32 number_captures = 81; // For multiple acquisitions of waveforms, e.g. Picoscope Rapid Block Mode
+            #     int32 accumulation_method = 82; // 0 for single-shot acquisition.  1: Averaging
+            #     int32 capture_idx = 83; // Segment this trace came from, 0 .. number_captures - 1
+
+            #     Timestamp timestamp = 91;
+            #     int32 acquisition_mode = 92;  // TODO: determine a mapping from Picoscope modes to integers
+            #     int32 osci_coupling = 93; // 0:DC coupling, 1:AC coupling
+
+            #     int32 trace_length = 100;
+            #     repeated float trace = 101; // Deprecated: no longer filled by the server, use int16_samples
+            #     repeated float times = 102; // Deprecated: no longer filled, the time axis is arange(trace_length) * sample_interval_ns
+            #     reserved 103;
+            #     bytes int16_samples = 104; // Raw ADC counts as packed little-endian int16
+            #     float scale_volts_per_count = 105; // volts = int16_samples * scale_volts_per_count
+            #     int32 n_saturated_samples = 106; // Samples at or beyond ADC full scale (clipped)
+            # }
+            # TODO: populate metadata
+            trace_proto = ChannelTrace()
+            trace_proto.channel_idx = channel_idx
+            trace_proto.timestamp = ts_proto
+            trace_proto.sample_interval_ns = self.timebase.sample_interval_ns
+            # sample_interval in seconds (time_interval_ns * 1e-9)
+            trace_proto.sample_interval = float(self.time_interval_ns) * 1.0e-9
+            trace_proto.number_captures = n_captures
+            trace_proto.capture_idx = capture_idx
+            # We send the raw little-endian int16 ADC counts (2 bytes per sample) and the scale to volts
+            trace_proto.trace_length = len(counts)
+            trace_proto.int16_samples = counts.astype('<i2', copy=False).tobytes()
+            trace_proto.scale_volts_per_count = volts_per_count
+            trace_proto.n_saturated_samples = int(channel_saturated[capture_idx])
+            all_traces_msg.traces.append(trace_proto)
+
+        return all_traces_msg
 
     async def stream_traces(self, message: Empty) -> AsyncIterator[AllTraces]:
         """
         - Set up self.loop and self.queue
         - Create the C‐callback pointer exactly once
-        - Repeatedly: start block, await queue.get(), yield it.
+        - Start the first block; block_ready_callback starts each following one
+        - Repeatedly: await queue.get(), yield it.
         """
         self.logger.info("Starting Block‐Mode Trace Stream!")
 
         # 1) Grab the current asyncio loop and create our queue
         self.loop = asyncio.get_running_loop()
-        self.queue = asyncio.Queue()
+        self.queue = asyncio.Queue(maxsize=_QUEUE_MAXSIZE)
 
         # 2) Build the C‐callable function pointer for block_ready_callback
-        #    (so PicoSDK will invoke self.block_ready_callback)
+        #    (so PicoSDK will invoke self.block_ready_callback), and start the thread that converts its blocks
         self.cFuncPtr = ps.BlockReadyType(self.block_ready_callback)
+        self._ready_slots = queue.SimpleQueue()
+        self._worker = threading.Thread(target=self._conversion_worker, args=(self._ready_slots,), daemon=True)
+        self._worker.start()
 
-        # 3) Continuously start a new block, wait for it, yield it
+        # 3) Kick off the first block capture, then keep yielding blocks as they are converted
+        self._streaming = True
         try:
+            self.util_run_block()
             while True:
-                # Kick off one block capture. As soon as it finishes, block_ready_callback will enqueue data.
-                self.util_run_block(self.timebase.timebase_idx,
-                                    self.timebase.preTriggerSamples,
-                                    self.timebase.postTriggerSamples)
-
-                # Wait until block_ready_callback pushes into self.queue
+                # Wait until the conversion worker pushes into self.queue
                 all_traces_msg: AllTraces = await self.queue.get()
 
-                # Yield the newly‐acquired block
-                yield all_traces_msg
+                # Blocks that queued up while the previous message was being sent go out together,
+                # so the gRPC framing cost is paid per batch rather than per block
+                for _ in range(_MAX_BLOCKS_PER_MESSAGE - 1):
+                    try:
+                        all_traces_msg.traces.extend(self.queue.get_nowait().traces)
+                    except asyncio.QueueEmpty:
+                        break
 
-                # Loop around: the next iteration will re‐trigger util_run_block()
+                # Yield the newly‐acquired block(s)
+                yield all_traces_msg
         finally:
-            # If the consumer cancels or the server shuts down, ensure we stop the scope
+            # If the consumer cancels or the server shuts down, ensure we stop the scope and the worker
+            self._streaming = False
             try:
                 ps.ps5000aStop(self.chandle)
                 ps.ps5000aCloseUnit(self.chandle)
             except Exception:
                 pass
+            # Anything a late callback queues after the sentinel stays in this stream's queue and is dropped
+            self._ready_slots.put(None)
+            self._worker.join()
+            self._ready_msgs.clear()
 
 
 if __name__ == "__main__":
@@ -492,7 +746,7 @@ if __name__ == "__main__":
             activate = True,
             trace_resolution_bits = 8,
             channel_coupling = 0,  # 0 for DC, 1 for AC
-            channel_voltage_scale = pu.valid_scales[9],
+            channel_voltage_scale = VoltScale(pu.valid_scale_names[9], pu.valid_scales[9]),
             analog_offset_volts = 0.0,  # No offset
         )
         response = await pu.configure_channel(channel_request)
@@ -528,8 +782,9 @@ if __name__ == "__main__":
         async for traces in pu.stream_traces(Empty()):
             logger.info(f"Received block with {len(traces.traces)} channels.")
             for tr in traces.traces:
-                logger.info(f"  Channel {tr.channel_idx}: {len(tr.trace)} samples @ {tr.sample_interval}s")
-                logger.info(tr.trace)
+                trace = np.frombuffer(tr.int16_samples, dtype='<i2') * tr.scale_volts_per_count
+                logger.info(f"  Channel {tr.channel_idx}: {len(trace)} samples @ {tr.sample_interval_ns} ns")
+                logger.info(trace)
 
     asyncio.run(run_stream())
 